@@ -1,7 +1,10 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from pathlib import Path
 import sys
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
 # Add parsers and core to path
@@ -16,6 +19,78 @@ from core.normalize import normalize_data
 from core.compare import compare_datasets
 from core.report import generate_excel_report
 
+
+# Streamlit reruns the whole script on every widget change, so parsing and
+# comparison results are cached. Uploads are keyed by a SHA-1 of their bytes;
+# the leading underscore stops Streamlit from hashing the raw bytes again.
+# Caches are shared by all sessions, so they are bounded in size and age.
+_CACHE_MAX_ENTRIES = 32
+_CACHE_TTL = 3600  # seconds
+
+
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES, ttl=_CACHE_TTL)
+def _parse_reconciliation_cached(file_key: bytes, _file_bytes: bytes):
+    return parse_reconciliation_excel(BytesIO(_file_bytes))
+
+
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES, ttl=_CACHE_TTL)
+def _parse_invoice_cached(file_key: bytes, invoice_ext: str, _file_bytes: bytes):
+    invoice_buffer = BytesIO(_file_bytes)
+    if invoice_ext == '.xml':
+        return parse_invoice_xml(invoice_buffer)
+    elif invoice_ext in ['.xlsx', '.xls']:
+        return parse_invoice_excel(invoice_buffer)
+    elif invoice_ext == '.pdf':
+        return parse_invoice_pdf(invoice_buffer)
+    elif invoice_ext in ['.png', '.jpg', '.jpeg']:
+        return parse_invoice_image(invoice_buffer)
+    raise ValueError(f"Unsupported file format: {invoice_ext}")
+
+
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES, ttl=_CACHE_TTL)
+def _normalize_cached(line_items, compare_after_discount: bool):
+    return normalize_data(line_items, compare_after_discount=compare_after_discount)
+
+
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES, ttl=_CACHE_TTL)
+def _compare_cached(normalized_reconciliation, normalized_invoice,
+                    reconciliation_totals, invoice_totals,
+                    vat_tolerance: float, amount_tolerance: float,
+                    fuzzy_match: bool):
+    return compare_datasets(
+        normalized_reconciliation,
+        normalized_invoice,
+        reconciliation_totals,
+        invoice_totals,
+        vat_tolerance=vat_tolerance,
+        amount_tolerance=amount_tolerance,
+        fuzzy_match=fuzzy_match
+    )
+
+
+def _file_key(file_bytes: bytes) -> bytes:
+    """Content hash used as the cache key for an uploaded file."""
+    return hashlib.sha1(file_bytes).digest()
+
+
+_MISMATCH_STATUSES = ['MISMATCH', 'MISSING_IN_INVOICE', 'EXTRA_IN_INVOICE']
+
+
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES, ttl=_CACHE_TTL)
+def _highlight_styles(comparison_df: pd.DataFrame) -> pd.DataFrame:
+    """Cell CSS highlighting mismatched rows in red, matched in green"""
+    status = comparison_df['status']
+    row_css = np.where(
+        status == 'MATCH',
+        'background-color: #d4edda',
+        np.where(status.isin(_MISMATCH_STATUSES), 'background-color: #f8d7da', '')
+    )
+    return pd.DataFrame(
+        np.repeat(row_css[:, np.newaxis], comparison_df.shape[1], axis=1),
+        index=comparison_df.index,
+        columns=comparison_df.columns
+    )
+
 st.set_page_config(
     page_title="Invoice Reconciliation Tool",
     page_icon="📊",
@@ -77,47 +152,53 @@ if reconciliation_file and invoice_file:
     try:
         with st.spinner("🔄 Processing files..."):
             
-            # Parse reconciliation file
-            st.info("📖 Parsing reconciliation Excel...")
-            reconciliation_data = parse_reconciliation_excel(reconciliation_file)
-            
-            # Parse invoice file based on extension
             invoice_ext = Path(invoice_file.name).suffix.lower()
-            st.info(f"📖 Parsing invoice file ({invoice_ext})...")
-            
-            if invoice_ext == '.xml':
-                invoice_data = parse_invoice_xml(invoice_file)
-            elif invoice_ext in ['.xlsx', '.xls']:
-                invoice_data = parse_invoice_excel(invoice_file)
-            elif invoice_ext == '.pdf':
-                invoice_data = parse_invoice_pdf(invoice_file)
-            elif invoice_ext in ['.png', '.jpg', '.jpeg']:
-                invoice_data = parse_invoice_image(invoice_file)
-            else:
+            if invoice_ext not in ['.xml', '.xlsx', '.xls', '.pdf', '.png', '.jpg', '.jpeg']:
                 st.error(f"Unsupported file format: {invoice_ext}")
                 st.stop()
             
+            # Parse reconciliation and invoice files concurrently; they are
+            # independent, so Excel parsing overlaps with invoice OCR
+            st.info(f"📖 Parsing reconciliation Excel and invoice file ({invoice_ext})...")
+            reconciliation_bytes = reconciliation_file.getvalue()
+            invoice_bytes = invoice_file.getvalue()
+            
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                reconciliation_future = executor.submit(
+                    _parse_reconciliation_cached,
+                    _file_key(reconciliation_bytes),
+                    reconciliation_bytes
+                )
+                invoice_future = executor.submit(
+                    _parse_invoice_cached,
+                    _file_key(invoice_bytes),
+                    invoice_ext,
+                    invoice_bytes
+                )
+                reconciliation_data = reconciliation_future.result()
+                invoice_data = invoice_future.result()
+            
             # Normalize data
             st.info("🔧 Normalizing data...")
-            normalized_reconciliation = normalize_data(
+            normalized_reconciliation = _normalize_cached(
                 reconciliation_data['line_items'],
-                compare_after_discount=compare_after_discount
+                compare_after_discount
             )
-            normalized_invoice = normalize_data(
+            normalized_invoice = _normalize_cached(
                 invoice_data['line_items'],
-                compare_after_discount=compare_after_discount
+                compare_after_discount
             )
             
             # Compare datasets
             st.info("🔍 Comparing data...")
-            comparison_result = compare_datasets(
+            comparison_result = _compare_cached(
                 normalized_reconciliation,
                 normalized_invoice,
                 reconciliation_data.get('totals', {}),
                 invoice_data.get('totals', {}),
-                vat_tolerance=vat_tolerance / 100,
-                amount_tolerance=amount_tolerance / 100,
-                fuzzy_match=fuzzy_match
+                vat_tolerance / 100,
+                amount_tolerance / 100,
+                fuzzy_match
             )
         
         st.success("✅ Processing complete!")
@@ -173,16 +254,8 @@ if reconciliation_file and invoice_file:
         
         comparison_df = comparison_result['comparison_table']
         
-        def highlight_mismatches(row):
-            """Highlight mismatched rows in red, matched in green"""
-            if row['status'] == 'MATCH':
-                return ['background-color: #d4edda'] * len(row)
-            elif row['status'] in ['MISMATCH', 'MISSING_IN_INVOICE', 'EXTRA_IN_INVOICE']:
-                return ['background-color: #f8d7da'] * len(row)
-            else:
-                return [''] * len(row)
-        
-        styled_df = comparison_df.style.apply(highlight_mismatches, axis=1)
+        highlight_styles = _highlight_styles(comparison_df)
+        styled_df = comparison_df.style.apply(lambda _: highlight_styles, axis=None)
         st.dataframe(styled_df, use_container_width=True, height=400)
         
         # Totals comparison
@@ -0,0 +1,90 @@
+"""
+Number Format Detection
+
+Shared by the reconciliation and invoice parsers.
+Detects whether a file writes its numbers with Vietnamese (1.000.000)
+or US (1,000,000) thousands separators, so that numbers in that format
+skip the generic separator heuristics.
+"""
+
+import re
+from contextvars import ContextVar
+from typing import Callable, Iterable, Optional, Pattern, Tuple
+
+
+NumberFormat = Tuple[Pattern, Callable[[str], float]]
+
+# Number format of the file being parsed (see detect_number_format).
+# A ContextVar rather than a plain global, since Streamlit sessions and
+# app.py's parser threads can parse several files at once.
+NUMBER_FORMAT: ContextVar[Optional[NumberFormat]] = ContextVar('NUMBER_FORMAT', default=None)
+
+# Integers with two or more thousands groups. Only these read the same
+# under every generic parser; a single group (50.000) or a decimal part
+# is ambiguous and stays with the generic parsers.
+_VN_NUMBER_RE = re.compile(r'-?\d{1,3}(?:\.\d{3}){2,}')
+_US_NUMBER_RE = re.compile(r'-?\d{1,3}(?:,\d{3}){2,}')
+
+# Only numbers containing a separator count toward the sample
+_FORMAT_SAMPLE_SIZE = 50
+
+
+def detect_number_format(samples: Iterable[str]) -> Optional[NumberFormat]:
+    """
+    Detect whether the first sample numbers use Vietnamese or US separators.
+    
+    Only well-formed thousands-grouped numbers count as evidence, so
+    phone numbers, dotted dates and tax codes are ignored.
+    
+    Args:
+        samples: Numeric strings, cleaned of currency symbols and whitespace
+    
+    Returns:
+        Tuple of (format pattern, specialized parser), or None when the
+        samples are mixed or give no evidence either way
+    """
+    vn = us = False
+    sampled = 0
+    for value_str in samples:
+        # Plain integers (row numbers, quantities) and stray punctuation
+        # say nothing about the format
+        if ('.' not in value_str and ',' not in value_str) or not any(c.isdigit() for c in value_str):
+            continue
+        
+        if _VN_NUMBER_RE.fullmatch(value_str):
+            vn = True
+        if _US_NUMBER_RE.fullmatch(value_str):
+            us = True
+        
+        sampled += 1
+        if sampled >= _FORMAT_SAMPLE_SIZE:
+            break
+    
+    if vn and not us:
+        return _VN_NUMBER_RE, _parse_vn_number
+    if us and not vn:
+        return _US_NUMBER_RE, _parse_us_number
+    return None
+
+
+def parse_in_format(value_str: str) -> Optional[float]:
+    """
+    Parse a cleaned numeric string written in the current file's format.
+    Returns None when no format is set or the string is not in it.
+    """
+    number_format = NUMBER_FORMAT.get()
+    if number_format is not None:
+        pattern, parse_fast = number_format
+        if pattern.fullmatch(value_str):
+            return parse_fast(value_str)
+    return None
+
+
+def _parse_vn_number(value_str: str) -> float:
+    """Vietnamese format: dots for thousands."""
+    return float(value_str.replace('.', ''))
+
+
+def _parse_us_number(value_str: str) -> float:
+    """US format: commas for thousands."""
+    return float(value_str.replace(',', ''))
@@ -4,14 +4,20 @@ Invoice PDF Parser
 Handles both text-based and scanned (image-based) PDFs.
 - Text-based PDFs: Direct text extraction
 - Scanned PDFs: Convert to images and apply OCR
+- Mixed PDFs: Only scanned pages (no text layer, but an image) are OCR'd
 """
 
-from typing import Dict, Any, List
-import fitz  # PyMuPDF alternative if available, otherwise use pdf2image
-from pdf2image import convert_from_bytes
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import fitz  # PyMuPDF
 from PIL import Image
-import io
+import hashlib
+import multiprocessing
+import os
 import re
+import threading
 from parsers.invoice_ocr import (
     parse_invoice_image,
     extract_line_items_from_text,
@@ -19,9 +25,44 @@ from parsers.invoice_ocr import (
     preprocess_image,
     get_ocr_engine
 )
+from parsers.number_format import NUMBER_FORMAT, detect_number_format, parse_in_format
 import numpy as np
 
 
+# Words of 3+ Latin/Vietnamese letters, used to tell real text from scan noise
+_WORD_RE = re.compile(r'\b[a-zA-Zàáảãạăắằẳẵặâấầẩẫậèéẻẽẹêềếểễệìíỉĩịòóỏõọôốồổỗộơớờởỡợùúủũụưứừửữựỳýỷỹỵđ]{3,}\b')
+_NUM_RE = re.compile(r'[\d.,]+')
+_NON_NUMERIC_RE = re.compile(r'[^0-9.,-]')
+
+# is_text_extractable only inspects this many leading characters
+_TEXT_SCAN_LIMIT = 20000
+
+# Pages with less text than this are treated as scanned and OCR'd
+_MIN_PAGE_TEXT = 20
+
+# Rasterization resolution for OCR; 200 dpi is plenty for invoice text
+_OCR_DPI = 200
+
+# OCR engine of the current process, created on first use (see _get_worker_ocr)
+_OCR = None
+
+# Long-lived OCR worker pool, created on first use (see _get_ocr_pool).
+# Workers are spawned, not forked: the Streamlit process is multi-threaded
+# and may already hold an initialized OCR engine.
+_OCR_POOL = None
+_OCR_POOL_LOCK = threading.Lock()
+# Each worker loads a full OCR engine (hundreds of MB plus its own threads),
+# and the pool is shared by every session, so keep it small
+_OCR_POOL_MAX_WORKERS = 4
+_OCR_POOL_WORKERS = min(_OCR_POOL_MAX_WORKERS, os.cpu_count() or 1)
+
+# Raw OCR lines per page image hash, least recently used first;
+# OCR output is deterministic per image
+_OCR_CACHE: 'OrderedDict[str, list]' = OrderedDict()
+_OCR_CACHE_SIZE = 256
+_OCR_CACHE_LOCK = threading.Lock()
+
+
 def parse_invoice_pdf(file) -> Dict[str, Any]:
     """
     Parse PDF invoice.
@@ -29,6 +70,7 @@ def parse_invoice_pdf(file) -> Dict[str, Any]:
     Strategy:
     1. Try text extraction first
     2. If text is minimal/poor, convert to images and use OCR
+    3. If only some pages are scanned images, OCR just those pages
     
     Args:
         file: File-like object (uploaded PDF)
@@ -37,59 +79,54 @@ def parse_invoice_pdf(file) -> Dict[str, Any]:
         Dictionary with 'line_items' list and 'totals' dict
     """
     try:
-        # Read PDF bytes
+        # Read PDF bytes and open the document once
         pdf_bytes = file.read()
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
         
-        # First, try text extraction
-        text_content = extract_text_from_pdf(pdf_bytes)
-        
-        # Check if text extraction was successful
-        # (some scanned PDFs have minimal/garbage text)
-        if is_text_extractable(text_content):
-            # Parse structured text
-            line_items = extract_line_items_from_text_content(text_content)
-            totals = extract_totals_from_text_content(text_content)
+        try:
+            # First, try text extraction
+            page_texts = [page.get_text() for page in doc]
+            text_content = ''.join(page_texts)
+            
+            # Check if text extraction was successful
+            # (some scanned PDFs have minimal/garbage text)
+            if not is_text_extractable(text_content):
+                # Fallback to OCR (scanned PDF)
+                return _parse_pages_with_ocr(doc, range(len(page_texts)))
+            
+            # Mixed PDF: OCR only scanned pages, i.e. pages without a text
+            # layer that carry an image (blank and footer-only pages don't)
+            ocr_pages = [
+                page_num for page_num, text in enumerate(page_texts)
+                if len(text.strip()) < _MIN_PAGE_TEXT and doc[page_num].get_images()
+            ]
+            if ocr_pages:
+                ocr_blocks = _ocr_page_blocks(doc, ocr_pages)
+                if any(ocr_blocks.values()):
+                    return _parse_page_blocks(doc, ocr_blocks)
+                # OCR found nothing; the text layer is all there is
+            
+            # Parse structured text, specializing on this file's number format
+            token = NUMBER_FORMAT.set(
+                detect_number_format(match.group() for match in _NUM_RE.finditer(text_content))
+            )
+            try:
+                line_items = extract_line_items_from_text_content(text_content)
+                totals = extract_totals_from_text_content(text_content)
+            finally:
+                NUMBER_FORMAT.reset(token)
             
             return {
                 'line_items': line_items,
                 'totals': totals
             }
-        else:
-            # Fallback to OCR (scanned PDF)
-            return parse_scanned_pdf(pdf_bytes)
+        finally:
+            doc.close()
         
     except Exception as e:
         raise Exception(f"Error parsing PDF invoice: {str(e)}")
 
 
-def extract_text_from_pdf(pdf_bytes: bytes) -> str:
-    """
-    Extract text from PDF using PyMuPDF (fitz).
-    Falls back to pdfplumber if needed.
-    """
-    try:
-        # Try PyMuPDF first
-        import fitz
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        text = ""
-        for page in doc:
-            text += page.get_text()
-        doc.close()
-        return text
-    except ImportError:
-        # Fallback to pdfplumber
-        try:
-            import pdfplumber
-            with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-                text = ""
-                for page in pdf.pages:
-                    text += page.extract_text() or ""
-                return text
-        except ImportError:
-            # If neither library available, return empty
-            return ""
-
-
 def is_text_extractable(text: str) -> bool:
     """
     Determine if extracted text is meaningful.
@@ -102,13 +139,20 @@ def is_text_extractable(text: str) -> bool:
     if len(clean_text) < 50:
         return False
     
-    # Check for actual words (not just garbage characters)
-    words = re.findall(r'\b[a-zA-Zàáảãạăắằẳẵặâấầẩẫậèéẻẽẹêềếểễệìíỉĩịòóỏõọôốồổỗộơớờởỡợùúủũụưứừửữựỳýỷỹỵđ]{3,}\b', clean_text)
-    
-    if len(words) < 5:
+    # Real text has plenty of whitespace-separated words (table cells are
+    # often on separate lines); OCR garbage layers rarely do
+    if len(clean_text.split(None, 20)) < 20:
         return False
     
-    return True
+    # Check for actual words (not just garbage characters).
+    # Five words in the first 20 KB is enough evidence, so stop early.
+    words = 0
+    for _ in _WORD_RE.finditer(clean_text, 0, _TEXT_SCAN_LIMIT):
+        words += 1
+        if words >= 5:
+            return True
+    
+    return False
 
 
 def extract_line_items_from_text_content(text: str) -> List[Dict]:
@@ -158,7 +202,7 @@ def parse_line_item(line: str) -> Dict:
     (product, denomination, quantity, amount)
     """
     # Extract all numbers from line
-    numbers = re.findall(r'[\d.,]+', line)
+    numbers = _NUM_RE.findall(line)
     
     if len(numbers) < 2:
         return None
@@ -168,7 +212,7 @@ def parse_line_item(line: str) -> Dict:
     
     # Extract product name (text before numbers)
     # Find position of first number
-    first_num_match = re.search(r'[\d.,]+', line)
+    first_num_match = _NUM_RE.search(line)
     if first_num_match:
         product = line[:first_num_match.start()].strip()
     else:
@@ -210,7 +254,7 @@ def extract_totals_from_text_content(text: str) -> Dict[str, float]:
         
         # VAT rate
         if 'vat' in line_lower or 'thuế' in line_lower:
-            numbers = re.findall(r'[\d.,]+', line)
+            numbers = _NUM_RE.findall(line)
             for num in numbers:
                 val = _parse_number(num)
                 if 0 < val < 100 and 'vat_rate' not in totals:
@@ -220,7 +264,7 @@ def extract_totals_from_text_content(text: str) -> Dict[str, float]:
         
         # Total before tax
         if any(kw in line_lower for kw in ['tổng trước thuế', 'subtotal', 'before tax']):
-            numbers = re.findall(r'[\d.,]+', line)
+            numbers = _NUM_RE.findall(line)
             for num in numbers:
                 val = _parse_number(num)
                 if val > 0:
@@ -229,7 +273,7 @@ def extract_totals_from_text_content(text: str) -> Dict[str, float]:
         
         # Total payment
         if any(kw in line_lower for kw in ['tổng thanh toán', 'tổng cộng', 'grand total', 'total payment']):
-            numbers = re.findall(r'[\d.,]+', line)
+            numbers = _NUM_RE.findall(line)
             for num in numbers:
                 val = _parse_number(num)
                 if val > 0:
@@ -243,58 +287,234 @@ def parse_scanned_pdf(pdf_bytes: bytes) -> Dict[str, Any]:
     Parse scanned PDF using OCR.
     Converts PDF pages to images and applies OCR.
     """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        return _parse_pages_with_ocr(doc, range(doc.page_count))
+    finally:
+        doc.close()
+
+
+def _parse_pages_with_ocr(doc: fitz.Document, ocr_pages) -> Dict[str, Any]:
+    """
+    Parse a PDF whose pages in ocr_pages need OCR.
+    Those pages are rasterized and OCR'd in parallel worker processes;
+    the remaining pages contribute their PyMuPDF text blocks directly.
+    """
     try:
-        # Convert PDF to images
-        images = convert_from_bytes(pdf_bytes, dpi=300)
+        return _parse_page_blocks(doc, _ocr_page_blocks(doc, ocr_pages))
+    except Exception as e:
+        raise Exception(f"Error processing scanned PDF: {str(e)}")
+
+
+def _ocr_page_blocks(doc: fitz.Document, ocr_pages) -> Dict[int, List[Dict]]:
+    """
+    Rasterize and OCR the pages in ocr_pages.
+    Returns the positioned text blocks of each OCR'd page by page number.
+    """
+    # Rasterize pages that need OCR as grayscale images
+    image_arrays = []
+    page_nums = []
+    for page_num in sorted(set(ocr_pages)):
+        pix = doc[page_num].get_pixmap(dpi=_OCR_DPI, colorspace=fitz.csGRAY)
+        image_array = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.h, pix.w, pix.n)
+        image_arrays.append(image_array[:, :, 0] if pix.n == 1 else image_array)
+        page_nums.append(page_num)
+    
+    # Only OCR images not seen before; identical pages are OCR'd once.
+    # This document's lines are kept locally, since the shared cache
+    # may evict them at any time.
+    page_keys = [_page_key(image_array) for image_array in image_arrays]
+    lines_by_key = {}
+    pending = {}
+    for key, image_array in zip(page_keys, image_arrays):
+        if key in lines_by_key or key in pending:
+            continue
+        cached = _cached_ocr_lines(key)
+        if cached is not None:
+            lines_by_key[key] = cached
+        else:
+            pending[key] = image_array
+    
+    # Process each page; a single page is not worth a process pool
+    if len(pending) > 1:
+        try:
+            page_lines = list(_get_ocr_pool().map(_ocr_page_lines, pending.values()))
+        except BrokenProcessPool:
+            _reset_ocr_pool()
+            raise
+    else:
+        page_lines = [_ocr_page_lines(image_array) for image_array in pending.values()]
+    
+    for key, lines in zip(pending, page_lines):
+        lines_by_key[key] = lines
+        _cache_ocr_lines(key, lines)
+    
+    return {
+        page_num: _blocks_from_ocr_lines(lines_by_key[key], page_num, image_array.shape[0])
+        for key, page_num, image_array in zip(page_keys, page_nums, image_arrays)
+    }
+
+
+def _parse_page_blocks(doc: fitz.Document, ocr_blocks: Dict[int, List[Dict]]) -> Dict[str, Any]:
+    """
+    Extract line items and totals from OCR'd page blocks, taking the
+    PyMuPDF text blocks of every page that was not OCR'd.
+    """
+    page_blocks = list(ocr_blocks.values())
+    
+    # Pages with a text layer skip OCR entirely
+    for page_num in range(doc.page_count):
+        if page_num not in ocr_blocks:
+            page_blocks.append(_text_blocks_from_page(doc[page_num], page_num))
+    
+    all_text_blocks = [block for blocks in page_blocks for block in blocks]
+    
+    # Sort by position
+    all_text_blocks.sort(key=lambda b: (b['page'], b['y']))
+    
+    # Extract structured data
+    line_items = extract_line_items_from_text(all_text_blocks)
+    totals = extract_totals_from_text(all_text_blocks)
+    
+    return {
+        'line_items': line_items,
+        'totals': totals
+    }
+
+
+def _text_blocks_from_page(page: fitz.Page, page_num: int) -> List[Dict]:
+    """
+    Convert a text page's PyMuPDF blocks into the same positioned block
+    structure produced by OCR, in the OCR pixel coordinate space.
+    """
+    scale = _OCR_DPI / 72
+    page_height = page.rect.height * scale
+    
+    blocks = []
+    for x0, y0, x1, y1, text, _block_no, block_type in page.get_text("blocks"):
+        # Skip image blocks
+        if block_type != 0:
+            continue
         
-        all_text_blocks = []
+        lines = [line.strip() for line in text.split('\n') if line.strip()]
+        line_height = (y1 - y0) / max(len(lines), 1)
         
-        # Process each page
-        for page_num, image in enumerate(images):
-            # Convert PIL image to numpy array
-            image_array = np.array(image)
-            
-            # Preprocess
-            from parsers.invoice_ocr import preprocess_image
-            preprocessed = preprocess_image(image_array)
+        for i, line in enumerate(lines):
+            top = (y0 + i * line_height) * scale
+            bottom = top + line_height * scale
+            bbox = [[x0 * scale, top], [x1 * scale, top], [x1 * scale, bottom], [x0 * scale, bottom]]
             
-            # Run OCR
-            ocr = get_ocr_engine()
-            result = ocr.ocr(preprocessed, cls=True)
-            
-            # Extract text blocks
-            if result and result[0]:
-                for line in result[0]:
-                    bbox = line[0]
-                    text = line[1][0]
-                    confidence = line[1][1]
-                    
-                    y_pos = bbox[0][1]
-                    x_pos = bbox[0][0]
-                    
-                    all_text_blocks.append({
-                        'text': text,
-                        'confidence': confidence,
-                        'x': x_pos,
-                        'y': y_pos + (page_num * 3000),  # Offset for page number
-                        'bbox': bbox,
-                        'page': page_num
-                    })
-        
-        # Sort by position
-        all_text_blocks.sort(key=lambda b: (b['page'], b['y']))
-        
-        # Extract structured data
-        line_items = extract_line_items_from_text(all_text_blocks)
-        totals = extract_totals_from_text(all_text_blocks)
+            blocks.append({
+                'text': line,
+                'confidence': 1.0,
+                'x': x0 * scale,
+                'y': top + page_num * page_height,  # Offset for page number
+                'bbox': bbox,
+                'page': page_num
+            })
+    
+    return blocks
+
+
+def _get_worker_ocr():
+    """Lazily create one OCR engine per (worker) process."""
+    global _OCR
+    if _OCR is None:
+        _OCR = get_ocr_engine()
+    return _OCR
+
+
+def _get_ocr_pool() -> ProcessPoolExecutor:
+    """
+    Return the shared OCR worker pool, creating it on first use.
+    Keeping it alive lets every worker reuse its loaded OCR engine.
+    """
+    global _OCR_POOL
+    with _OCR_POOL_LOCK:
+        if _OCR_POOL is None:
+            _OCR_POOL = ProcessPoolExecutor(
+                max_workers=_OCR_POOL_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _OCR_POOL
+
+
+def _reset_ocr_pool() -> None:
+    """Drop a broken pool so the next scan starts a fresh one."""
+    global _OCR_POOL
+    with _OCR_POOL_LOCK:
+        if _OCR_POOL is not None:
+            _OCR_POOL.shutdown(wait=False, cancel_futures=True)
+            _OCR_POOL = None
+
+
+def _ocr_page_lines(image_array: np.ndarray) -> list:
+    """
+    OCR a single page image and return the engine's raw lines.
+    Runs inside a worker process, so it must stay a module-level function.
+    """
+    # Pages are rendered single-channel; preprocess_image expects colour input
+    if image_array.ndim == 2:
+        image_array = np.repeat(image_array[:, :, np.newaxis], 3, axis=2)
+    
+    # Preprocess
+    preprocessed = preprocess_image(image_array)
+    
+    # Run OCR
+    ocr = _get_worker_ocr()
+    # Invoice scans are upright, so skip angle classification
+    result = ocr.ocr(preprocessed, cls=False)
+    
+    return result[0] if result and result[0] else []
+
+
+def _blocks_from_ocr_lines(lines: list, page_num: int, page_height: int) -> List[Dict]:
+    """Convert raw OCR lines of one page into positioned text blocks."""
+    blocks = []
+    for line in lines:
+        bbox = line[0]
+        text = line[1][0]
+        confidence = line[1][1]
         
-        return {
-            'line_items': line_items,
-            'totals': totals
-        }
+        y_pos = bbox[0][1]
+        x_pos = bbox[0][0]
         
-    except Exception as e:
-        raise Exception(f"Error processing scanned PDF: {str(e)}")
+        blocks.append({
+            'text': text,
+            'confidence': confidence,
+            'x': x_pos,
+            'y': y_pos + page_num * page_height,  # Offset for page number
+            'bbox': bbox,
+            'page': page_num
+        })
+    
+    return blocks
+
+
+def _page_key(image_array: np.ndarray) -> str:
+    """Content hash of a page image, used as the OCR cache key."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(image_array.shape).encode())
+    digest.update(np.ascontiguousarray(image_array))
+    return digest.hexdigest()
+
+
+def _cached_ocr_lines(key: str) -> Optional[list]:
+    """Look up cached OCR output, marking it as recently used."""
+    with _OCR_CACHE_LOCK:
+        lines = _OCR_CACHE.get(key)
+        if lines is not None:
+            _OCR_CACHE.move_to_end(key)
+        return lines
+
+
+def _cache_ocr_lines(key: str, lines: list) -> None:
+    """Store OCR output, evicting the least recently used pages when full."""
+    with _OCR_CACHE_LOCK:
+        _OCR_CACHE[key] = lines
+        _OCR_CACHE.move_to_end(key)
+        while len(_OCR_CACHE) > _OCR_CACHE_SIZE:
+            _OCR_CACHE.popitem(last=False)
 
 
 def _parse_number(value) -> float:
@@ -304,8 +524,17 @@ def _parse_number(value) -> float:
     
     value_str = str(value).strip()
     
+    # Plain ASCII digit strings need no cleanup
+    if value_str.isascii() and value_str.isdigit():
+        return float(value_str)
+    
     # Remove non-numeric chars except dots, commas, minus
-    value_str = re.sub(r'[^0-9.,-]', '', value_str)
+    value_str = _NON_NUMERIC_RE.sub('', value_str)
+    
+    # Numbers written in this file's format go straight to its parser
+    parsed = parse_in_format(value_str)
+    if parsed is not None:
+        return parsed
     
     # Handle Vietnamese format
     if '.' in value_str and ',' in value_str:
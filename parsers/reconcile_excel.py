@@ -5,9 +5,60 @@ Parses reconciliation Excel files with Vietnamese headers.
 Handles multiple sections and flexible column layouts.
 """
 
+import numpy as np
 import pandas as pd
 import re
-from typing import Dict, List, Any
+from typing import Dict, Iterable, Iterator, List, Any, Sequence, Tuple
+
+from parsers.number_format import NUMBER_FORMAT, detect_number_format, parse_in_format
+
+
+# Header detection
+_HEADER_RE = re.compile('|'.join([
+    r'loại\s*sản\s*phẩm',
+    r'mệnh\s*giá',
+    r'số\s*lượng',
+    r'thành\s*tiền'
+]))
+
+# Column mapping
+_COL_PRODUCT = re.compile(r'loại|sản\s*phẩm|tên')
+_COL_DENOMINATION = re.compile(r'mệnh\s*giá|denomination')
+_COL_QUANTITY = re.compile(r'số\s*lượng|quantity')
+_COL_AMOUNT = re.compile(r'thành\s*tiền|amount|tổng')
+_COL_DISCOUNT = re.compile(r'chiết\s*khấu|discount|giảm\s*giá')
+
+# Totals
+_TOTAL_VAT_RATE = re.compile(r'thuế\s*vat|vat\s*rate|%\s*vat')
+_TOTAL_VAT_AMOUNT = re.compile(r'tiền\s*thuế|vat\s*amount')
+_TOTAL_BEFORE_TAX = re.compile(r'tổng\s*trước\s*thuế|before\s*tax|subtotal')
+_TOTAL_PAYMENT = re.compile(r'tổng\s*thanh\s*toán|total\s*payment|grand\s*total|tổng\s*cộng')
+_TOTALS_RE = re.compile('|'.join(
+    p.pattern for p in (_TOTAL_VAT_RATE, _TOTAL_VAT_AMOUNT, _TOTAL_BEFORE_TAX, _TOTAL_PAYMENT)
+))
+
+# Summary rows (end of a table section)
+_SUMMARY_RE = re.compile('|'.join([
+    r'tổng\s*cộng',
+    r'tổng\s*thanh\s*toán',
+    r'thuế\s*vat',
+    r'grand\s*total',
+    r'total\s*payment'
+]))
+
+# Any run of Unicode whitespace, normalized in row text
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Number parsing: currency letters (any case) and all whitespace are dropped.
+# The whitespace is every character for which str.isspace() is true.
+_NUM_STRIP = str.maketrans('', '', (
+    '₫đĐvVnNdD'
+    ' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f\x85\xa0\u1680'
+    '\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a'
+    '\u2028\u2029\u202f\u205f\u3000'
+))
+_NUM_EXTRACT = re.compile(r'-?[\d.]+')
+_NUM_CHARS = '0123456789.,-'
 
 
 def parse_reconciliation_excel(file) -> Dict[str, Any]:
@@ -21,21 +72,25 @@ def parse_reconciliation_excel(file) -> Dict[str, Any]:
         Dictionary with 'line_items' DataFrame and 'totals' dict
     """
     try:
-        # Read all sheets
-        excel_file = pd.ExcelFile(file)
+        # Read all sheets in a single pass
+        sheets = _read_all_sheets(file)
         all_line_items = []
         totals = {}
         
-        for sheet_name in excel_file.sheet_names:
-            df = pd.read_excel(file, sheet_name=sheet_name, header=None)
-            
-            # Extract line items from this sheet
-            items, sheet_totals = _extract_line_items_from_sheet(df)
-            all_line_items.extend(items)
-            
-            # Merge totals (last sheet wins)
-            if sheet_totals:
-                totals.update(sheet_totals)
+        # Specialize number parsing on the format this file uses
+        number_format = detect_number_format(_number_strings(sheets.values()))
+        token = NUMBER_FORMAT.set(number_format)
+        try:
+            for sheet_name, df in sheets.items():
+                # Extract line items from this sheet
+                items, sheet_totals = _extract_line_items_from_sheet(df)
+                all_line_items.extend(items)
+                
+                # Merge totals (last sheet wins)
+                if sheet_totals:
+                    totals.update(sheet_totals)
+        finally:
+            NUMBER_FORMAT.reset(token)
         
         # Convert to DataFrame
         if all_line_items:
@@ -55,6 +110,19 @@ def parse_reconciliation_excel(file) -> Dict[str, Any]:
         raise Exception(f"Error parsing reconciliation Excel: {str(e)}")
 
 
+def _read_all_sheets(file) -> Dict[str, pd.DataFrame]:
+    """
+    Read every sheet of the workbook into a dict of DataFrames.
+    Uses the Rust-based calamine engine when installed, otherwise openpyxl.
+    """
+    try:
+        return pd.read_excel(file, sheet_name=None, header=None, engine='calamine')
+    except ImportError:
+        if hasattr(file, 'seek'):
+            file.seek(0)
+        return pd.read_excel(file, sheet_name=None, header=None)
+
+
 def _extract_line_items_from_sheet(df: pd.DataFrame) -> tuple:
     """
     Extract line items from a single sheet.
@@ -66,61 +134,66 @@ def _extract_line_items_from_sheet(df: pd.DataFrame) -> tuple:
     line_items = []
     totals = {}
     
+    # Raw cells and their null mask, looked up by position from here on
+    values = df.to_numpy(dtype=object)
+    notna_mask = pd.notna(values)
+    
+    # Lowercased text of every row, built once and searched vectorized
+    row_strings = _row_strings(df, notna_mask)
+    
     # Find all header rows (rows containing key Vietnamese terms)
-    header_patterns = [
-        r'loại\s*sản\s*phẩm',
-        r'mệnh\s*giá',
-        r'số\s*lượng',
-        r'thành\s*tiền'
-    ]
+    potential_headers = row_strings.index[row_strings.str.contains(_HEADER_RE)].tolist()
     
-    potential_headers = []
-    for idx, row in df.iterrows():
-        row_str = ' '.join([str(cell).lower() for cell in row if pd.notna(cell)])
-        if any(re.search(pattern, row_str) for pattern in header_patterns):
-            potential_headers.append(idx)
+    # Rows that end a section: empty rows or summary keywords
+    stop_mask = _empty_row_mask(notna_mask) | _summary_row_mask(row_strings).to_numpy(dtype=bool)
     
     # Extract data from each header section
     for header_idx in potential_headers:
-        items = _extract_section(df, header_idx)
+        items = _extract_section(values, notna_mask, header_idx, stop_mask)
         line_items.extend(items)
     
     # Extract totals (look for VAT, total payment keywords)
-    totals = _extract_totals(df)
+    totals = _extract_totals(values, notna_mask, row_strings)
     
     return line_items, totals
 
 
-def _extract_section(df: pd.DataFrame, header_idx: int) -> List[Dict]:
+def _extract_section(values: np.ndarray, notna_mask: np.ndarray,
+                     header_idx: int, stop_mask: np.ndarray) -> List[Dict]:
     """
     Extract line items from a section starting at header_idx.
+    The section ends at the first row flagged in stop_mask.
     """
     items = []
     
     # Map columns
-    header_row = df.iloc[header_idx]
+    header_row = values[header_idx]
     column_map = _map_columns(header_row)
     
     if not column_map:
         return items
     
-    # Extract data rows (until empty row or another header)
-    for idx in range(header_idx + 1, len(df)):
-        row = df.iloc[idx]
-        
-        # Stop at empty row or summary keywords
-        if _is_empty_row(row) or _is_summary_row(row):
-            break
-        
-        # Extract item
-        item = _extract_item(row, column_map)
+    # Data rows run until the first empty row or summary keywords
+    start_idx = header_idx + 1
+    breaks = np.flatnonzero(stop_mask[start_idx:])
+    end_idx = start_idx + breaks[0] if len(breaks) else len(values)
+    
+    # Take only the mapped columns, re-keyed to positions in the block
+    fields = list(column_map)
+    positional_map = {field: pos for pos, field in enumerate(fields)}
+    columns = [column_map[f] for f in fields]
+    rows = values[start_idx:end_idx, columns]
+    rows_notna = notna_mask[start_idx:end_idx, columns]
+    
+    for row, row_notna in zip(rows, rows_notna):
+        item = _extract_item(row, row_notna, positional_map)
         if item:
             items.append(item)
     
     return items
 
 
-def _map_columns(header_row: pd.Series) -> Dict[str, int]:
+def _map_columns(header_row: Sequence) -> Dict[str, int]:
     """
     Map Vietnamese column headers to column indices.
     """
@@ -130,31 +203,33 @@ def _map_columns(header_row: pd.Series) -> Dict[str, int]:
         cell_str = str(cell).lower().strip()
         
         # Product type
-        if re.search(r'loại|sản\s*phẩm|tên', cell_str):
+        if _COL_PRODUCT.search(cell_str):
             column_map['product'] = idx
         
         # Denomination
-        elif re.search(r'mệnh\s*giá|denomination', cell_str):
+        elif _COL_DENOMINATION.search(cell_str):
             column_map['denomination'] = idx
         
         # Quantity
-        elif re.search(r'số\s*lượng|quantity', cell_str):
+        elif _COL_QUANTITY.search(cell_str):
             column_map['quantity'] = idx
         
         # Amount
-        elif re.search(r'thành\s*tiền|amount|tổng', cell_str) and 'tổng cộng' not in cell_str:
+        elif _COL_AMOUNT.search(cell_str) and 'tổng cộng' not in cell_str:
             column_map['amount'] = idx
         
         # Discount (optional)
-        elif re.search(r'chiết\s*khấu|discount|giảm\s*giá', cell_str):
+        elif _COL_DISCOUNT.search(cell_str):
             column_map['discount'] = idx
     
     return column_map
 
 
-def _extract_item(row: pd.Series, column_map: Dict[str, int]) -> Dict:
+def _extract_item(row: Sequence, row_notna: Sequence, column_map: Dict[str, int]) -> Dict:
     """
     Extract a single line item from a row.
+    Cells are looked up by position, so row can be any sequence;
+    row_notna flags which of its cells hold a value.
     """
     try:
         product = str(row[column_map['product']]) if 'product' in column_map else ''
@@ -163,33 +238,31 @@ def _extract_item(row: pd.Series, column_map: Dict[str, int]) -> Dict:
         amount = row[column_map['amount']] if 'amount' in column_map else 0
         
         # Skip if missing critical data
-        if pd.isna(product) or product.strip() == '' or product == 'nan':
+        if product.strip() == '' or product == 'nan':
             return None
         
         # Parse denomination (handle various formats)
-        if pd.notna(denomination):
+        if 'denomination' not in column_map or row_notna[column_map['denomination']]:
             denomination = _parse_number(denomination)
         else:
             denomination = 0
         
         # Parse quantity
-        if pd.notna(quantity):
+        if 'quantity' not in column_map or row_notna[column_map['quantity']]:
             quantity = _parse_number(quantity)
         else:
             quantity = 0
         
         # Parse amount
-        if pd.notna(amount):
+        if 'amount' not in column_map or row_notna[column_map['amount']]:
             amount = _parse_money(amount)
         else:
             amount = 0
         
         # Extract discount if available
         discount = 0
-        if 'discount' in column_map:
-            discount_val = row[column_map['discount']]
-            if pd.notna(discount_val):
-                discount = _parse_money(discount_val)
+        if 'discount' in column_map and row_notna[column_map['discount']]:
+            discount = _parse_money(row[column_map['discount']])
         
         return {
             'product_type': product.strip(),
@@ -203,45 +276,52 @@ def _extract_item(row: pd.Series, column_map: Dict[str, int]) -> Dict:
         return None
 
 
-def _extract_totals(df: pd.DataFrame) -> Dict[str, float]:
+def _extract_totals(values: np.ndarray, notna_mask: np.ndarray,
+                    row_strings: pd.Series) -> Dict[str, float]:
     """
     Extract summary totals (VAT, total payment) from sheet.
+    Only rows whose text mentions a total keyword are scanned cell by cell.
     """
     totals = {}
     
-    for idx, row in df.iterrows():
-        row_str = ' '.join([str(cell).lower() for cell in row if pd.notna(cell)])
+    # One sweep over all rows finds every row mentioning any total keyword
+    candidate_rows = row_strings.index[row_strings.str.contains(_TOTALS_RE)]
+    
+    for idx in candidate_rows:
+        # Non-null cells of the row
+        row = values[idx][notna_mask[idx]]
+        row_str = row_strings[idx]
         
         # Look for VAT rate
-        if re.search(r'thuế\s*vat|vat\s*rate|%\s*vat', row_str):
+        if _TOTAL_VAT_RATE.search(row_str):
             for cell in row:
-                if pd.notna(cell) and isinstance(cell, (int, float)):
+                if isinstance(cell, (int, float)):
                     if 0 < cell < 100:  # Likely a percentage
                         totals['vat_rate'] = cell
                         break
         
         # Look for VAT amount
-        if re.search(r'tiền\s*thuế|vat\s*amount', row_str):
+        if _TOTAL_VAT_AMOUNT.search(row_str):
             for cell in row:
-                if pd.notna(cell) and isinstance(cell, (int, float, str)):
+                if isinstance(cell, (int, float, str)):
                     val = _parse_money(cell)
                     if val > 0:
                         totals['vat_amount'] = val
                         break
         
         # Look for total before tax
-        if re.search(r'tổng\s*trước\s*thuế|before\s*tax|subtotal', row_str):
+        if _TOTAL_BEFORE_TAX.search(row_str):
             for cell in row:
-                if pd.notna(cell) and isinstance(cell, (int, float, str)):
+                if isinstance(cell, (int, float, str)):
                     val = _parse_money(cell)
                     if val > 0:
                         totals['total_before_tax'] = val
                         break
         
         # Look for total payment
-        if re.search(r'tổng\s*thanh\s*toán|total\s*payment|grand\s*total|tổng\s*cộng', row_str):
+        if _TOTAL_PAYMENT.search(row_str):
             for cell in row:
-                if pd.notna(cell) and isinstance(cell, (int, float, str)):
+                if isinstance(cell, (int, float, str)):
                     val = _parse_money(cell)
                     if val > 0:
                         totals['total_payment'] = val
@@ -260,8 +340,17 @@ def _parse_number(value) -> float:
     
     value_str = str(value).strip()
     
+    # Plain digit strings need no cleanup
+    if value_str.isdecimal():
+        return float(value_str)
+    
     # Remove currency symbols and whitespace
-    value_str = re.sub(r'[₫đvnd\s]', '', value_str, flags=re.IGNORECASE)
+    value_str = value_str.translate(_NUM_STRIP)
+    
+    # Numbers written in this file's format go straight to its parser
+    parsed = parse_in_format(value_str)
+    if parsed is not None:
+        return parsed
     
     # Handle Vietnamese format: 1.000.000,50 or 1,000,000.50
     # Count dots and commas to determine format
@@ -276,7 +365,7 @@ def _parse_number(value) -> float:
         value_str = value_str.replace(',', '')
     
     # Extract number
-    match = re.search(r'-?[\d.]+', value_str)
+    match = _NUM_EXTRACT.search(value_str)
     if match:
         try:
             return float(match.group())
@@ -286,6 +375,20 @@ def _parse_number(value) -> float:
     return 0
 
 
+def _number_strings(sheets: Iterable[pd.DataFrame]) -> Iterator[str]:
+    """
+    Yield numeric-looking text cells (cleaned of currency symbols and
+    whitespace), in sheet and row order.
+    """
+    for df in sheets:
+        for cell in df.to_numpy(dtype=object).ravel():
+            if not isinstance(cell, str):
+                continue
+            value_str = cell.strip().translate(_NUM_STRIP)
+            if value_str and not value_str.strip(_NUM_CHARS) and any(c.isdigit() for c in value_str):
+                yield value_str
+
+
 def _parse_money(value) -> float:
     """
     Parse money value (same as _parse_number but more explicit for amounts)
@@ -293,20 +396,31 @@ def _parse_money(value) -> float:
     return _parse_number(value)
 
 
-def _is_empty_row(row: pd.Series) -> bool:
-    """Check if row is empty or mostly empty."""
-    non_null = row.notna().sum()
-    return non_null <= 1
+def _row_strings(df: pd.DataFrame, notna_mask: np.ndarray) -> pd.Series:
+    """Lowercased, space-joined text of the non-null cells of each row."""
+    if df.empty:
+        return pd.Series('', index=df.index, dtype=object)
+    # Object dtype keeps Python str semantics (pandas 3 defaults to Arrow)
+    text = df.astype(str).astype(object).where(notna_mask, '')
+    row_strings = text.agg(' '.join, axis=1).str.lower()
+    
+    # Arrow's RE2 kernels treat \s as ASCII-only, so collapse all Unicode
+    # whitespace (e.g. non-breaking spaces) to plain spaces with Python re
+    row_strings = row_strings.str.replace(_WHITESPACE_RE, ' ', regex=True)
+    
+    # Arrow-backed strings keep the text in one contiguous buffer and run
+    # the str.contains sweeps in Arrow's regex kernels
+    try:
+        return row_strings.astype('string[pyarrow]')
+    except ImportError:
+        return row_strings
+
+
+def _empty_row_mask(notna_mask: np.ndarray) -> np.ndarray:
+    """Flag rows that are empty or mostly empty."""
+    return notna_mask.sum(axis=1) <= 1
 
 
-def _is_summary_row(row: pd.Series) -> bool:
-    """Check if row contains summary keywords."""
-    row_str = ' '.join([str(cell).lower() for cell in row if pd.notna(cell)])
-    summary_patterns = [
-        r'tổng\s*cộng',
-        r'tổng\s*thanh\s*toán',
-        r'thuế\s*vat',
-        r'grand\s*total',
-        r'total\s*payment'
-    ]
-    return any(re.search(pattern, row_str) for pattern in summary_patterns)
+def _summary_row_mask(row_strings: pd.Series) -> pd.Series:
+    """Flag rows containing summary keywords."""
+    return row_strings.str.contains(_SUMMARY_RE)